@@ -12,15 +12,39 @@ Nomenclatura de Layout:
 
 import fitz  # PyMuPDF
 import argparse
+import functools
 import sys
 import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Optional, Sequence
 
 # Constante de conversión
 mm = 2.83465  # 1mm = 2.83465 puntos
 
+# Etiquetas por defecto: A..Z y luego AA..AZ
+_DEFAULT_LABELS = tuple(chr(65 + i) for i in range(26)) + tuple(f"A{chr(65 + i)}" for i in range(26))
+
+def _render_page_png(path: str, zoom: float) -> bytes:
+    """Rasteriza la primera página de un PDF a PNG (se ejecuta en otro proceso)."""
+    with fitz.open(path, filetype='pdf') as doc:
+        pix = doc.load_page(0).get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False, annots=False)
+        return pix.tobytes('png')
+
+@dataclass
+class Metrics:
+    """Dimensiones de los PDFs de entrada, una lista por campo (mismo orden que las rutas)."""
+    widths: List[float]
+    heights: List[float]
+    ratios: List[float]
+    paths: List[str]
+    docs: List[fitz.Document]
+
 class PanelGenerator:
+    # Fuente de las etiquetas, compartida por todas las instancias
+    _HELV_BOLD = None
+
     def __init__(self, 
                  page_width: float = 180,
                  page_height: float = None,  # Si es None, se autocalcula
@@ -29,203 +53,341 @@ class PanelGenerator:
                  label_size: int = 12):
         self.page_width_mm = page_width
         self.page_height_mm = page_height
+        self.page_width_pt = page_width * mm
+        self.page_height_pt = page_height * mm if page_height else None
         self.margin = margin * mm
         self.spacing = spacing * mm
         self.label_size = label_size
         
-        self.usable_width = (page_width * mm) - 2 * self.margin
+        self.usable_width = self.page_width_pt - 2 * self.margin
+        
+        if PanelGenerator._HELV_BOLD is None:
+            PanelGenerator._HELV_BOLD = fitz.Font("Helvetica-Bold")
+        self._font = PanelGenerator._HELV_BOLD
 
-    def get_pdf_metrics(self, file_paths: List[str]) -> List[Dict[str, float]]:
-        """Obtiene dimensiones y aspect ratio de cada PDF."""
-        metrics = []
-        for path in file_paths:
-            try:
-                doc = fitz.open(path)
-                page = doc[0]
-                rect = page.rect
-                metrics.append({
-                    'width': rect.width,
-                    'height': rect.height,
-                    'ratio': rect.width / rect.height if rect.height > 0 else 1.0,
-                    'path': path
-                })
+    def _probe(self, path: str) -> Tuple[float, float, fitz.Document]:
+        """Abre un PDF y devuelve (ancho, alto, documento) (usado por get_pdf_metrics)."""
+        try:
+            # filetype='pdf' evita que PyMuPDF tenga que adivinar el formato
+            doc = fitz.open(path, filetype='pdf')
+            if doc.needs_pass or doc.page_count == 0:
+                reason = "está protegido con contraseña" if doc.needs_pass else "no tiene páginas"
                 doc.close()
-            except Exception as e:
-                print(f"⚠️ Error leyendo {path}: {e}")
-                metrics.append({'width': 100, 'height': 100, 'ratio': 1.0, 'path': path})
-        return metrics
+                raise ValueError(f"el PDF {reason}")
+            rect = doc.load_page(0).rect
+            return rect.width, rect.height, doc
+        except Exception as e:
+            # Sin el documento no se puede componer el panel: se falla aquí
+            raise ValueError(f"No se pudo leer {path}: {e}") from e
 
-    def parse_layout_structure(self, layout_str: str, num_files: int) -> List[List[int]]:
+    def get_pdf_metrics(self, file_paths: List[str]) -> Metrics:
         """
-        Convierte el layout string en una estructura de filas y columnas.
-        Ej: 'AB-C' o '2,1' -> [[0, 1], [2]] (índices de los archivos)
+        Obtiene dimensiones y aspect ratio de cada PDF.
+        Los archivos se abren uno a uno: PyMuPDF no admite uso desde varios
+        hilos y los documentos se usan después en el hilo principal.
+        
+        El documento abierto se conserva en 'docs' para reutilizarlo al
+        componer el panel; quien llama es responsable de cerrarlo (una vez
+        por documento, aunque se repita la ruta).
         """
-        structure = []
+        # Una misma figura puede aparecer varias veces: se abre una sola vez
+        # y todas sus entradas comparten el mismo documento
+        probed = {}
+        try:
+            for path in file_paths:
+                if path not in probed:
+                    probed[path] = self._probe(path)
+        except Exception:
+            # No dejar abiertos los documentos leídos antes del error
+            for _, _, doc in probed.values():
+                doc.close()
+            raise
+        widths, heights, docs = [], [], []
+        for path in file_paths:
+            width, height, doc = probed[path]
+            widths.append(width)
+            heights.append(height)
+            docs.append(doc)
+        ratios = [w / h if h > 0 else 1.0 for w, h in zip(widths, heights)]
+        return Metrics(widths, heights, ratios, list(file_paths), docs)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=128)
+    def parse_layout_structure(layout_str: str, num_files: int) -> Tuple[Tuple[int, ...], ...]:
+        """
+        Convierte el layout string en una estructura de filas y columnas.
+        Ej: 'AB-C' o '2,1' -> ((0, 1), (2,)) (índices de los archivos)
         
-        # Caso '2x2'
-        if 'x' in layout_str.lower():
-            try:
-                cols, rows = map(int, layout_str.lower().split('x'))
-                idx = 0
-                for r in range(rows):
-                    row = []
-                    for c in range(cols):
-                        if idx < num_files:
-                            row.append(idx)
-                            idx += 1
-                    if row: structure.append(row)
-            except ValueError:
-                pass
+        El string se recorre una sola vez: ',' y '-' separan filas, un número
+        indica cuántas figuras lleva la fila, cualquier otro carácter cuenta
+        como una figura y 'NxM' define una grilla de N columnas y M filas.
+        El resultado se cachea, por eso es inmutable.
+        """
+        row_counts = []
+        grid_cols = None    # Columnas de la grilla si aparece el marcador 'x'
+        value = 0           # Número acumulado en el token actual
+        length = 0          # Caracteres del token actual
+        only_digits = True
+        valid = True
         
-        # Caso '2,1' o '2-1'
-        elif ',' in layout_str or '-' in layout_str:
-            sep = ',' if ',' in layout_str else '-'
-            try:
-                row_counts = [int(x) if x.isdigit() else len(x) for x in layout_str.split(sep)]
-                idx = 0
-                for count in row_counts:
-                    row = []
-                    for _ in range(count):
-                        if idx < num_files:
-                            row.append(idx)
-                            idx += 1
-                    if row: structure.append(row)
-            except:
-                pass
+        for ch in layout_str:
+            if ch.isspace():
+                continue
+            if '0' <= ch <= '9':
+                value = value * 10 + ord(ch) - 48
+                length += 1
+            elif ch == ',' or ch == '-':
+                if grid_cols is not None:
+                    valid = False
+                    break
+                row_counts.append(value if only_digits else length)
+                value, length, only_digits = 0, 0, True
+            elif ch == 'x' or ch == 'X':
+                # Solo es grilla si lo anterior es un número y no hubo filas
+                if grid_cols is not None or row_counts or not only_digits or length == 0:
+                    valid = False
+                    break
+                grid_cols = value
+                value, length = 0, 0
+            else:
+                if grid_cols is not None:
+                    valid = False
+                    break
+                only_digits = False
+                length += 1
         
-        # Caso simple 'ABC' o '3'
+        if not valid:
+            row_counts = []
+        elif grid_cols is not None:
+            row_counts = [grid_cols] * value if length else []
         else:
-            if layout_str.isdigit():
-                count = int(layout_str)
-                structure.append(list(range(min(count, num_files))))
-            else:
-                structure.append(list(range(min(len(layout_str), num_files))))
+            row_counts.append(value if only_digits else length)
+        
+        structure = []
+        idx = 0
+        for count in row_counts:
+            row = tuple(range(idx, min(idx + count, num_files)))
+            if row:
+                structure.append(row)
+                idx += len(row)
                 
         # Validar que todos los archivos estén
-        total_in_struct = sum(len(r) for r in structure)
-        if total_in_struct < num_files:
+        if idx < num_files:
             # Agregar faltantes en una nueva fila
-            remaining = list(range(total_in_struct, num_files))
-            structure.append(remaining)
+            structure.append(tuple(range(idx, num_files)))
             
-        return structure
+        return tuple(structure)
 
-    def calculate_layout(self, structure: List[List[int]], metrics: List[Dict]) -> Dict[str, Any]:
+    @staticmethod
+    def _flatten_structure(structure: Sequence[Sequence[int]], num_files: int) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
         """
-        Calcula las alturas ideales de las filas y posiciones finales.
+        Normaliza la estructura a formato plano: los índices de todas las filas
+        seguidos y el offset donde empieza cada fila (el último es len(indices)).
+        La fila r es indices[row_offsets[r]:row_offsets[r + 1]].
+        Descarta filas vacías y valida que los índices existan.
+        """
+        indices = []
+        row_offsets = [0]
+        for row in structure:
+            if row:
+                indices.extend(row)
+                row_offsets.append(len(indices))
+        for i in indices:
+            if not 0 <= i < num_files:
+                raise ValueError(f"Índice de figura fuera de rango en el layout: {i}")
+        return tuple(indices), tuple(row_offsets)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=128)
+    def _layout_geometry(indices: Tuple[int, ...], row_offsets: Tuple[int, ...], ratios: Tuple[float, ...],
+                         usable_width: float, spacing: float, margin: float,
+                         label_size: int, page_height_pt: Optional[float]) -> Tuple[float, Tuple[tuple, ...]]:
+        """
+        Parte puramente geométrica de calculate_layout. Solo depende de
+        valores inmutables, así que se cachea para layouts repetidos.
+        La estructura llega aplanada (ver _flatten_structure) y ratios va
+        alineado con indices, no con los archivos.
+        Devuelve (alto de página, paneles).
         """
-        layout_rows = []
-        
         # 1. Calcular el 'ancho relativo' de cada fila basado en el ancho total de la página
         # y cuánto alto necesitaría esa fila para que sus figuras quepan sin distorsión.
         
+        num_rows = len(row_offsets) - 1
+        row_panel_widths = []
         row_ideal_heights = []
-        for row_indices in structure:
-            row_metrics = [metrics[i] for i in row_indices]
-            num_panels = len(row_indices)
+        for r in range(num_rows):
+            num_panels = row_offsets[r + 1] - row_offsets[r]
             
             # Espacio disponible para figuras en esta fila (puntos)
-            avail_w = self.usable_width - (num_panels - 1) * self.spacing
+            avail_w = usable_width - (num_panels - 1) * spacing
             
             # Ancho de cada panel en la fila
             panel_w = avail_w / num_panels
+            row_panel_widths.append(panel_w)
             
-            # Altura requerida por la figura más 'exigente' (la más alta proporcionalmente)
+            # Altura requerida por la figura más 'exigente' (la de menor ratio)
             # + espacio para la etiqueta (+4 puntos de margen interno)
-            required_height = 0
-            for m in row_metrics:
-                h_at_panel_w = panel_w / m['ratio']
-                required_height = max(required_height, h_at_panel_w)
+            required_height = panel_w / min(ratios[row_offsets[r]:row_offsets[r + 1]])
             
-            row_ideal_heights.append(required_height + self.label_size + 4)
+            row_ideal_heights.append(required_height + label_size + 4)
 
         # 2. Determinar altura de página
-        total_ideal_height = sum(row_ideal_heights) + (len(structure) - 1) * self.spacing + 2 * self.margin
+        ideal_rows_height = sum(row_ideal_heights)
+        total_ideal_height = ideal_rows_height + (num_rows - 1) * spacing + 2 * margin
         
-        final_page_height = self.page_height_mm * mm if self.page_height_mm else total_ideal_height
-        final_usable_height = final_page_height - 2 * self.margin - (len(structure) - 1) * self.spacing
+        final_page_height = page_height_pt if page_height_pt else total_ideal_height
+        final_usable_height = final_page_height - 2 * margin - (num_rows - 1) * spacing
         
         # 3. Escalar alturas si la página es fija
-        if self.page_height_mm:
-            scale_factor = final_usable_height / sum(row_ideal_heights) if sum(row_ideal_heights) > 0 else 1.0
+        if page_height_pt:
+            scale_factor = final_usable_height / ideal_rows_height if ideal_rows_height > 0 else 1.0
             actual_row_heights = [h * scale_factor for h in row_ideal_heights]
         else:
             actual_row_heights = row_ideal_heights
 
-        # 4. Generar coordenadas finales
+        # 4. Generar coordenadas finales: (índice, rect del panel, rect de la figura)
         panel_configs = []
-        current_y = self.margin
-        for row_idx, row_indices in enumerate(structure):
-            h = actual_row_heights[row_idx]
-            num_panels = len(row_indices)
-            avail_w = self.usable_width - (num_panels - 1) * self.spacing
-            panel_w = avail_w / num_panels
+        label_h = label_size + 4
+        current_y = margin
+        for r, panel_w, h in zip(range(num_rows), row_panel_widths, actual_row_heights):
+            # Área para la figura (restando el espacio reservado para la etiqueta)
+            fig_y = current_y + label_h
+            fig_h = h - label_h
+            # Todos los paneles de la fila tienen el mismo tamaño, así que el
+            # ajuste solo depende del ratio. Con figuras idénticas (lo habitual)
+            # se calcula una vez por fila: (ancho, alto, desplazamiento x, y)
+            fits = {}
+            current_x = margin
+            for k in range(row_offsets[r], row_offsets[r + 1]):
+                ratio = ratios[k]
+                fit = fits.get(ratio)
+                if fit is None:
+                    # La figura ocupa todo el ancho salvo que no quepa a lo alto
+                    fit_height = panel_w / ratio
+                    if fit_height <= fig_h:
+                        sw, sh = panel_w, fit_height
+                    else:
+                        sw, sh = fig_h * ratio, fig_h
+                    # Centrar en el área disponible para la figura
+                    fit = fits[ratio] = (sw, sh, (panel_w - sw) / 2, fig_y + (fig_h - sh) / 2)
+                sw, sh, ox, dy = fit
+                dx = current_x + ox
+                panel_configs.append((indices[k], (current_x, current_y, current_x + panel_w, current_y + h),
+                                      (dx, dy, dx + sw, dy + sh)))
+                current_x += panel_w + spacing
+            current_y += h + spacing
             
-            current_x = self.margin
-            for i in row_indices:
-                panel_configs.append({
-                    'index': i,
-                    'rect': fitz.Rect(current_x, current_y, current_x + panel_w, current_y + h),
-                    'path': metrics[i]['path']
-                })
-                current_x += panel_w + self.spacing
-            current_y += h + self.spacing
+        return final_page_height, tuple(panel_configs)
+
+    @staticmethod
+    def _close_docs(metrics: Metrics) -> None:
+        """Cierra cada documento de entrada una sola vez (las rutas repetidas lo comparten)."""
+        for doc in {id(doc): doc for doc in metrics.docs}.values():
+            if not doc.is_closed:
+                doc.close()
+
+    def calculate_layout(self, structure: Sequence[Sequence[int]], metrics: Metrics) -> Dict[str, Any]:
+        """
+        Calcula las alturas ideales de las filas y posiciones finales.
+        """
+        indices, row_offsets = self._flatten_structure(structure, len(metrics.ratios))
+        ratios = tuple(metrics.ratios[i] for i in indices)
+        final_page_height, geometry = self._layout_geometry(
+            indices, row_offsets, ratios,
+            self.usable_width, self.spacing, self.margin, self.label_size, self.page_height_pt)
+        
+        panel_configs = [{
+            'index': i,
+            'rect': fitz.Rect(rect),
+            'dest': fitz.Rect(dest),
+            'path': metrics.paths[i]
+        } for i, rect, dest in geometry]
             
         return {
-            'page_size': (self.page_width_mm * mm, final_page_height),
+            'page_size': (self.page_width_pt, final_page_height),
             'panels': panel_configs
         }
 
-    def generate(self, layout_str: str, input_files: List[str], output_file: str, labels: List[str] = None):
+    def generate(self, layout_str: str, input_files: List[str], output_file: str, labels: List[str] = None,
+                 parallel: bool = False):
+        """
+        Compone el panel y lo guarda en output_file.
+        Con parallel=True cada figura se rasteriza a self.dpi en un pool de
+        procesos y se inserta como imagen, de modo que el panel deja de ser
+        vectorial. Los documentos de entrada solo se usan para medir y se
+        cierran antes de componer, ya que cada worker abre su archivo.
+        """
         metrics = self.get_pdf_metrics(input_files)
-        structure = self.parse_layout_structure(layout_str, len(input_files))
-        result = self.calculate_layout(structure, metrics)
-        
-        pw, ph = result['page_size']
-        print(f"🚀 Generando panel: {pw/mm:.1f}x{ph/mm:.1f} mm")
-        
-        doc_out = fitz.open()
-        page_out = doc_out.new_page(width=pw, height=ph)
-        
-        for i, config in enumerate(result['panels']):
-            rect = config['rect']
-            doc_in = fitz.open(config['path'])
-            page_in = doc_in[0]
+        doc_out = None
+        try:
+            structure = self.parse_layout_structure(layout_str, len(input_files))
+            result = self.calculate_layout(structure, metrics)
             
-            # Área para la figura (restando el espacio reservado para la etiqueta)
-            fig_rect = fitz.Rect(rect.x0, rect.y0 + self.label_size + 4, rect.x1, rect.y1)
+            pw, ph = result['page_size']
+            print(f"🚀 Generando panel: {pw/mm:.1f}x{ph/mm:.1f} mm")
             
-            in_rect = page_in.rect
-            scale_w = fig_rect.width / in_rect.width
-            scale_h = fig_rect.height / in_rect.height
-            scale = min(scale_w, scale_h)
+            doc_out = fitz.open()
+            page_out = doc_out.new_page(width=pw, height=ph)
+            # Todas las etiquetas se acumulan y se escriben de una sola vez
+            label_writer = fitz.TextWriter(page_out.rect)
+            # Las etiquetas personalizadas que falten se completan con las por defecto
+            custom = tuple(labels) if labels else ()
+            effective_labels = custom + _DEFAULT_LABELS[len(custom):]
             
-            # Centrar en el área disponible para la figura
-            sw, sh = in_rect.width * scale, in_rect.height * scale
-            dx = (fig_rect.width - sw) / 2
-            dy = (fig_rect.height - sh) / 2
-            dest = fitz.Rect(fig_rect.x0 + dx, fig_rect.y0 + dy, fig_rect.x0 + dx + sw, fig_rect.y0 + dy + sh)
+            rendered = []
+            if parallel:
+                # Los Document no pasan entre procesos: cada worker abre su archivo,
+                # así que los abiertos para medir ya no hacen falta
+                self._close_docs(metrics)
+                panels = result['panels']
+                paths = [metrics.paths[c['index']] for c in panels]
+                zooms = [c['dest'].width / metrics.widths[c['index']] * self.dpi / 72.0 for c in panels]
+                workers = min(os.cpu_count() or 1, 4, max(len(panels), 1))
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    rendered = list(executor.map(_render_page_png, paths, zooms))
+        
+            for i, config in enumerate(result['panels']):
+                rect = config['rect']
             
-            page_out.show_pdf_page(dest, doc_in, 0)
+                if parallel:
+                    page_out.insert_image(config['dest'], stream=rendered[i])
+                else:
+                    # Se inserta como Form XObject: no arrastra anotaciones ni campos de
+                    # formulario, y PyMuPDF reutiliza el xref si la misma página se repite
+                    page_out.show_pdf_page(config['dest'], metrics.docs[config['index']], 0)
             
-            # Etiqueta (en el espacio reservado justo arriba de la figura)
-            txt = labels[i] if labels and i < len(labels) else chr(65 + i)
-            page_out.insert_text((rect.x0, rect.y0 + self.label_size), 
-                                 txt, fontsize=self.label_size, fontname="Helvetica-Bold")
-            doc_in.close()
+                # Etiqueta (en el espacio reservado justo arriba de la figura)
+                txt = effective_labels[i] if i < len(effective_labels) else str(i + 1)
+                label_writer.append((rect.x0, rect.y0 + self.label_size),
+                                    txt, font=self._font, fontsize=self.label_size)
             
-        # Determinar formato de salida
-        ext = os.path.splitext(output_file)[1].lower()
-        if ext in ['.png', '.jpg', '.jpeg', '.tiff', '.tif']:
-            pix = page_out.get_pixmap(dpi=self.dpi)
-            pix.save(output_file)
-        elif ext == '.svg':
-            with open(output_file, "w", encoding="utf-8") as f:
-                f.write(page_out.get_svg_content())
-        else:
-            doc_out.save(output_file)
+            label_writer.write_text(page_out)
             
-        doc_out.close()
+            # Determinar formato de salida
+            ext = os.path.splitext(output_file)[1].lower()
+            if ext in ['.png', '.jpg', '.jpeg', '.tiff', '.tif']:
+                zoom = self.dpi / 72.0
+                mat = fitz.Matrix(zoom, zoom)
+                pix = page_out.get_pixmap(matrix=mat, alpha=False, annots=False)
+                # Con matrix= el pixmap queda marcado a 96 DPI: se restaura el real
+                pix.set_dpi(self.dpi, self.dpi)
+                if ext in ['.tiff', '.tif']:
+                    # MuPDF no codifica TIFF: se delega en Pillow
+                    pix.pil_save(output_file, compression="tiff_lzw")
+                else:
+                    fmt = 'jpeg' if ext in ['.jpg', '.jpeg'] else 'png'
+                    Path(output_file).write_bytes(pix.tobytes(fmt))
+            elif ext == '.svg':
+                svg_bytes = page_out.get_svg_image().encode("utf-8")
+                Path(output_file).write_bytes(svg_bytes)
+            else:
+                # TextWriter incrusta la fuente completa: solo se guardan los glifos usados
+                doc_out.subset_fonts()
+                doc_out.save(output_file)
+        finally:
+            if doc_out is not None:
+                doc_out.close()
+            self._close_docs(metrics)
         print(f"✅ Guardado en: {output_file} (DPI: {self.dpi})")
 
 if __name__ == "__main__":
@@ -240,9 +402,11 @@ if __name__ == "__main__":
     parser.add_argument("--label-size", type=int, default=14, help="Tamaño de letra")
     parser.add_argument("--labels", nargs="+", help="Etiquetas personalizadas")
     parser.add_argument("--dpi", type=int, default=300, help="DPI para exportar a imagen (default: 300)")
+    parser.add_argument("--parallel", action="store_true",
+                        help="Rasteriza las figuras en varios procesos a --dpi (el panel deja de ser vectorial)")
     
     args = parser.parse_args()
     
     gen = PanelGenerator(args.page_width, args.page_height, args.margin, args.spacing, args.label_size)
     gen.dpi = args.dpi # Inyección rápida de DPI
-    gen.generate(args.layout, args.input, args.output, args.labels)
+    gen.generate(args.layout, args.input, args.output, args.labels, parallel=args.parallel)